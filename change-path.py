@@ -1,32 +1,62 @@
 import os
 import pandas as pd
+from multiprocessing import Pool, cpu_count
 
-def change_image_paths(csv_folder, new_image_path):
+def change_image_paths_file(params):
+    """This function tranform the path of the images of one csv or parquet file
+
+    Args:
+        params (tuple): path of the file, the name of the new path and the format of the file ('csv' or 'parquet')
+
+    Returns:
+        filename: name of the file that was changed
+    """
+
+    # Get the path of the file, the new path of the images and the format
+    file_path, new_image_path, file_format = params
+
+    # Load the file, with the paths as strings for faster string operations
+    if file_format == 'parquet':
+        df = pd.read_parquet(file_path)
+        df['image_path'] = df['image_path'].astype('string')
+    else:
+        df = pd.read_csv(file_path, engine='c', dtype={'image_path': 'string'})
+
+    # Change image paths in the 'image_path' column (keeping only the name of the image)
+    basenames = df['image_path'].str.rsplit(os.sep, n=1).str[-1]
+    df['image_path'] = os.path.join(new_image_path, '') + basenames
+
+    # Save the modified DataFrame back to the file
+    if file_format == 'parquet':
+        df.to_parquet(file_path, compression='zstd', index=False)
+    else:
+        df.to_csv(file_path, index=False)
+
+    return os.path.basename(file_path)
+
+def change_image_paths(csv_folder, new_image_path, file_format='csv'):
     """This function tranform the path of a csv into another one, is useful for the detection process of the images
-    This function asumes that the column image_path is the name of the path of the image
+    This function asumes that the column image_path is the name of the path of the image.
+    Parquet files are much faster to read and write than csv, so they can be used instead
 
     Args:
         csv_folder (str): the folder where are the csv files
         new_image_path (str): the name of the new path
+        file_format (str, optional): format of the files, 'csv' or 'parquet'. Defaults to 'csv'.
     """
 
     try:
-        # Iterate over each file in the CSV folder
-        for filename in os.listdir(csv_folder):
-            # For the csv files of the folder
-            if filename.endswith(".csv"):
-
-                # Get the peth
-                file_path = os.path.join(csv_folder, filename)
+        # Get the files of the folder with the chosen format
+        extension = ".parquet" if file_format == 'parquet' else ".csv"
+        files = [
+            (os.path.join(csv_folder, filename), new_image_path, file_format)
+            for filename in os.listdir(csv_folder)
+            if filename.endswith(extension)
+        ]
 
-                # Load CSV file
-                df = pd.read_csv(file_path)
-
-                # Change image paths in the 'image_path' column
-                df['image_path'] = df['image_path'].apply(lambda x: os.path.join(new_image_path, os.path.basename(x)))
-
-                # Save the modified DataFrame back to the CSV file
-                df.to_csv(file_path, index=False)
+        # Every file is independent, so we change them in parallel
+        with Pool(max(1, cpu_count() - 1)) as pool:
+            for filename in pool.imap_unordered(change_image_paths_file, files):
 
                 # Printing for debugging 
                 print(f"Image paths in '{filename}' changed successfully.")
@@ -34,13 +64,13 @@ def change_image_paths(csv_folder, new_image_path):
     except Exception as e:
         print("An error occurred:", e)
 
-# Example usage:
-# Csv folder which contains the csv files
-csv_folder = "/Users/fernandalecaros/Documents/Data/1500det/det_filtered/csv/"
-
-# New path for the image_path in the csv
-new_image_path = "/Users/fernandalecaros/Documents/Data/1500/"
+if __name__ == "__main__":
+    # Example usage:
+    # Csv folder which contains the csv files
+    csv_folder = "/Users/fernandalecaros/Documents/Data/1500det/det_filtered/csv/"
 
+    # New path for the image_path in the csv
+    new_image_path = "/Users/fernandalecaros/Documents/Data/1500/"
 
-# Using the function
-change_image_paths(csv_folder, new_image_path)
+    # Using the function
+    change_image_paths(csv_folder, new_image_path)
@@ -1,14 +1,41 @@
 import os
+import re
 import random
 import shutil
 import pygame
 from pygame.locals import *
 from tqdm import tqdm
-import multiprocessing
-from PIL import Image
-import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
+# Images that we will analyze: they must have an image extention, start with CFE and end with m (depth)
+IMAGE_PATTERN = re.compile(r'^CFE.*m\.(?i:png|jpg|jpeg|gif|bmp|tiff)$')
+
+def walk_images(directory):
+    """Recursively yield the image files from the given directory that match IMAGE_PATTERN.
+
+    Args:
+        directory (str): path to the images
+
+    Yields:
+        path: path of an image that we will analyze
+    """
+
+    # Folders that we still have to read
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+
+                # Read the subfolders later, the type comes from the folder listing without extra calls
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+
+                # We are oly interested in the images that has depth
+                elif IMAGE_PATTERN.match(entry.name):
+                    yield entry.path
+
 def get_all_images(directory):
     """Recursively get all image files from the given directory. 
     They must have an image extention, start with CFE and ends with m (depth)
@@ -20,36 +47,61 @@ def get_all_images(directory):
        all_images: images that we will analyze
     """
 
-    # Images extension 
-    image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')
-    all_images = []
-    
-    # Choosing the images that I will analyze
-    for root, _, files in os.walk(directory):
-        for file in files:
+    return list(walk_images(directory))
 
-            # They must start with CFE and end with m (we are oly interested in the images that has depth)
-            if file.lower().endswith(image_extensions) and file.startswith('CFE') and file.endswith('m' + file[-4:]):
+def copy_image(image, destination_dir):
+    """Copy one image to the destination folder, skipping it if it already exists
 
-                # Adding the images to the list of the images that I will analyze
-                all_images.append(os.path.join(root, file))
-    
-    return all_images
+    Args:
+        image (str): path of the image
+        destination_dir (str): folder where the image will be copied
+
+    Returns:
+        copied: True if the image was copied
+    """
+
+    try:
+
+        # Copying the images
+        image_filename = os.path.basename(image)
+        destination_path = os.path.join(destination_dir, image_filename)
+        
+        # Check if file already exists in destination
+        if os.path.exists(destination_path):
+            print(f"File {image_filename} already exists in {destination_dir}. Skipping...")
+            return False
+        
+        # Hard link the image (only one inode operation), if it is not possible copy it.
+        # The images are only reviewed, so both paths sharing the same file is not a problem
+        try:
+            os.link(image, destination_path)
+        except OSError:
+            shutil.copyfile(image, destination_path)
+        return True
+
+    except PermissionError as e:
+        print(f"Permission denied: {e}. Skipping this file.")
+    except Exception as e:
+        print(f"Error copying {image}: {e}")
+    return False
 
-def copy_images(source_dir, destination_dir, num_images):
+def copy_images(source_dir, destination_dir, num_images, all_images=None):
     """_summary_
 
     Args:
         source_dir (str): folder which containes the images
         destination_dir (str): new folder with the amount of images that i choose
         num_images (int): the amount of images that i want to analyze
+        all_images (list, optional): images available in source_dir, if None they are searched. 
+                                     The selected images are removed from the list. Defaults to None.
 
     Returns:
         copied_count: number of images in the new folder
     """
 
     # Getting all the images that are available
-    all_images = get_all_images(source_dir)
+    if all_images is None:
+        all_images = get_all_images(source_dir)
 
     # Getting the total of images
     total_images = len(all_images)
@@ -61,137 +113,189 @@ def copy_images(source_dir, destination_dir, num_images):
     
     # Selecting randomly the images based on the number that I specified
     selected_images = random.sample(all_images, num_images)
+
+    # The selected images are removed from the available ones, so they are not selected again
+    selected_set = set(selected_images)
+    all_images[:] = [image for image in all_images if image not in selected_set]
     
     # Making sure that the path exists, if not i will create it
     if not os.path.exists(destination_dir):
         os.makedirs(destination_dir)
     
-    # Copying images in the new folder
-    copied_count = 0
-    for image in tqdm(selected_images, desc="Copying images"):
-        try:
-
-            # Copying the images
-            image_filename = os.path.basename(image)
-            destination_path = os.path.join(destination_dir, image_filename)
-            
-            # Check if file already exists in destination
-            if os.path.exists(destination_path):
-                print(f"File {image_filename} already exists in {destination_dir}. Skipping...")
-                continue
-            
-            shutil.copy(image, destination_path)
-            copied_count += 1
-
-        except PermissionError as e:
-            print(f"Permission denied: {e}. Skipping this file.")
-        except Exception as e:
-            print(f"Error copying {image}: {e}")
+    # Copying images in the new folder, with several threads so the copies overlap
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        copied = list(tqdm(
+            executor.map(lambda image: copy_image(image, destination_dir), selected_images),
+            total=len(selected_images),
+            desc="Copying images"
+        ))
+    copied_count = sum(copied)
     
     print(f"Copied {copied_count} images to {destination_dir}")
     return copied_count
 
-def read_image(path):
-    """Read an image from the given path and return its raw data.
+def load_image(path):
+    """Load an image from the given path as a pygame surface scaled to 50% of its original size.
 
     Args:
         path (str): the path to read the image
+
+    Returns:
+        image: the pygame surface, None if the image could not be read
     """
 
     try:
 
-        # Reading the image
-        with open(path, 'rb') as f:
-            return f.read()
-        
+        # SDL reads and decodes the file from its path straight into a pygame surface,
+        # the raw bytes of the file are never copied into python
+        image = pygame.image.load(path)
+
+        # Scale image to 50% of original size
+        new_size = (image.get_width() // 2, image.get_height() // 2)
+        return pygame.transform.smoothscale(image, new_size)
+
     except Exception as e:
         print(f"Error reading image {path}: {e}")
         return None
 
-def upload_images_multiprocessing(directory):
-    """Load images from the given directory using multiprocessing.
+def add_to_cache(index, surface, surf_cache, cache_size=64):
+    """Add a loaded image to the cache, converting it to the pixel format of the screen.
 
     Args:
-        directory (str): path to the images
+        index (int): index of the image
+        surface (pygame.Surface): the loaded image, None if the image could not be read
+        surf_cache (OrderedDict): surfaces of the last images shown
+        cache_size (int, optional): maximum number of surfaces in the cache. Defaults to 64.
 
     Returns:
-        images: list of images that i will show
-        path: list with the images paths
+        surface: the converted surface, None if the image could not be read
     """
 
-    # Read the images with the extensions 
-    image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')
-    paths = []
-
-    # Collect image paths
-    for root, _, files in os.walk(directory):
-        for file in files:
-            # Images containing CFE and m in their names
-            if file.lower().endswith(image_extensions) and file.startswith('CFE') and file.endswith('m' + file[-4:]):
-                path = os.path.join(root, file)
-                paths.append(path)
-
-    # Use multiprocessing to read images
-    pool = multiprocessing.Pool()
-    images_data = pool.map(read_image, paths)
-    pool.close()
-    pool.join()
-
-    # Filter out None values (failed to read images)
-    images_data = [img_data for img_data in images_data if img_data is not None]
-
-    # Convert raw data to pygame surfaces
-    images = []
-    for img_data in images_data:
-        try:
-            # Open the images in pygame
-            img = Image.open(io.BytesIO(img_data))
-            mode = img.mode
-            size = img.size
-            data = img.tobytes()
-            image = pygame.image.fromstring(data, size, mode)
-
-            # Scale image to 50% of original size
-            new_size = (image.get_width() // 2, image.get_height() // 2)
-            image = pygame.transform.scale(image, new_size)
-
-            # Images that I will show
-            images.append(image)
-        except Exception as e:
-            print(f"Error converting image data: {e}")
+    # Convert the image to the pixel format of the screen, so blitting it is faster
+    if surface is not None:
+        surface = surface.convert()
+
+    # Add the image to the cache and remove the oldest one if the cache is full
+    surf_cache[index] = surface
+    if len(surf_cache) > cache_size:
+        _, evicted = surf_cache.popitem(last=False)
+        del evicted
+
+    return surface
 
-    return images, paths
+def get_surface(index, image_paths, surf_cache, pending, cache_size=64):
+    """Get the surface of an image from the cache, from the images that are loading 
+    in the background or loading it right now.
+
+    Args:
+        index (int): index of the image
+        image_paths (list): paths of the images
+        surf_cache (OrderedDict): surfaces of the last images shown
+        pending (dict): futures of the images that are loading in the background
+        cache_size (int, optional): maximum number of surfaces in the cache. Defaults to 64.
+
+    Returns:
+        surface: the surface of the image, None if the image could not be read
+    """
+
+    # The image is in the cache
+    if index in surf_cache:
+        surf_cache.move_to_end(index)
+        return surf_cache[index]
+
+    # The image is loading in the background, otherwise load it now
+    future = pending.pop(index, None)
+    surface = future.result() if future is not None else load_image(image_paths[index])
+    return add_to_cache(index, surface, surf_cache, cache_size)
+
+def prefetch_images(index, image_paths, surf_cache, pending, executor, prefetch=4):
+    """Load in the background the current image and the ones around it.
+
+    Args:
+        index (int): index of the current image
+        image_paths (list): paths of the images
+        surf_cache (OrderedDict): surfaces of the last images shown
+        pending (dict): futures of the images that are loading in the background
+        executor (ThreadPoolExecutor): threads that load the images
+        prefetch (int, optional): number of images to load before and after the current one. Defaults to 4.
+    """
+
+    num_images = len(image_paths)
+    wanted = {(index + offset) % num_images for offset in range(-prefetch, prefetch + 1)}
+
+    # The images that are not needed anymore are kept in the cache if they are already loaded, 
+    # otherwise they are cancelled
+    for pending_index in list(pending):
+        if pending_index not in wanted:
+            future = pending.pop(pending_index)
+            if future.done() and not future.cancelled():
+                add_to_cache(pending_index, future.result(), surf_cache)
+            else:
+                future.cancel()
+
+    # Load the images that are not in the cache
+    for wanted_index in wanted:
+        if wanted_index not in surf_cache and wanted_index not in pending:
+            pending[wanted_index] = executor.submit(load_image, image_paths[wanted_index])
 
 def show_images(directory):
-    """Function that shows the images to review them with pygame
+    """Function that shows the images to review them with pygame.
+    The images are loaded only when they are needed, keeping in memory the last ones shown
+    and loading in the background the ones around the current image.
 
     Args:
         directory (str): path to the images
+
+    Returns:
+        deleted_count: number of images deleted
     """
 
     pygame.init()
 
-    # Load images from directory using multiprocessing
-    images, image_paths = upload_images_multiprocessing(directory)
-    num_images = len(images)
+    # Get the paths of the images
+    image_paths = get_all_images(directory)
+    num_images = len(image_paths)
     index_actual_image = 0
 
     # List to keep track of images to delete
     images_to_delete = []
 
-    # Exit if there are no valid images to display
+    # Exit if there are no images to display
     if num_images == 0:
         print(f"No valid images in {directory}. Exiting...")
         pygame.quit()
-        return
+        return 0
+
+    # Get the first image that can be read to know the size of the screen
+    first_image = None
+    while first_image is None and index_actual_image < num_images:
+        first_image = load_image(image_paths[index_actual_image])
+        if first_image is None:
+            index_actual_image += 1
+
+    # Exit if there are no valid images to display
+    if first_image is None:
+        print(f"No valid images in {directory}. Exiting...")
+        pygame.quit()
+        return 0
 
     # Set up the screen
-    screen = pygame.display.set_mode(images[0].get_rect().size)
+    screen = pygame.display.set_mode(first_image.get_rect().size)
     pygame.display.set_caption('Image Viewer')
-    screen.blit(images[index_actual_image], (0, 0))
+
+    # Cache of the images and images loading in the background
+    surf_cache = OrderedDict()
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=2)
+    surf_cache[index_actual_image] = first_image.convert()
+    prefetch_images(index_actual_image, image_paths, surf_cache, pending, executor)
+
+    screen.blit(surf_cache[index_actual_image], (0, 0))
     pygame.display.flip()
 
-    # Main loop
+    # Main loop, the screen is only drawn again when the image changes
+    clock = pygame.time.Clock()
+    redraw = False
     running = True
     while running:
         # Get keyboard and window events
@@ -199,14 +303,21 @@ def show_images(directory):
             # Exit the loop if the window is closed 
             if event.type == QUIT:
                 running = False  
+            # Draw again if the window was hidden
+            elif event.type in (VIDEOEXPOSE, WINDOWEXPOSED):
+                redraw = True
             elif event.type == KEYDOWN:
                 # Left arrow key to continue seeing the images
                 if event.key == K_LEFT:  
                     index_actual_image = (index_actual_image - 1) % num_images
+                    redraw = True
+                    prefetch_images(index_actual_image, image_paths, surf_cache, pending, executor)
                     print(f"Showing previous image. New index: {index_actual_image}")
                  # Right arrow key to see the images that I just past
                 elif event.key == K_RIGHT: 
                     index_actual_image = (index_actual_image + 1) % num_images
+                    redraw = True
+                    prefetch_images(index_actual_image, image_paths, surf_cache, pending, executor)
                     print(f"Showing next image. New index: {index_actual_image}")
                 # Up arrow key to delete the image
                 elif event.key == K_UP:  
@@ -215,27 +326,42 @@ def show_images(directory):
                         print(f"Image marked for deletion: {index_actual_image}")
 
         # Update screen with the new image
-        # Clear the screen with black
-        screen.fill((0, 0, 0))  
-        if num_images > 0:
+        if redraw:
+            # Clear the screen with black
+            screen.fill((0, 0, 0))  
+            image = get_surface(index_actual_image, image_paths, surf_cache, pending)
+            if image is not None:
 
-            # Show current image
-            screen.blit(images[index_actual_image], (0, 0)) 
+                # Show current image
+                screen.blit(image, (0, 0)) 
 
-        # Update the screen
-        pygame.display.flip()  
+            # Update the screen
+            pygame.display.flip()  
+            redraw = False
+
+        # Wait for the next frame instead of looping as fast as possible
+        clock.tick(60)
+
+    # Stop loading images in the background
+    executor.shutdown(wait=True, cancel_futures=True)
+    surf_cache.clear()
+    pending.clear()
 
     pygame.quit()
 
     # Delete images marked for deletion
+    deleted_count = 0
     for index in images_to_delete:
         try:
             current_image_path = image_paths[index]
             os.remove(current_image_path)
+            deleted_count += 1
             print(f"Image deleted: {current_image_path}")
         except Exception as e:
             print(f"Error deleting image {current_image_path}: {e}")
 
+    return deleted_count
+
 def check_and_fill_images(source_directory, destination_directory, number_of_images):
     """Function to review the amoount of images and fill if its necessary 
 
@@ -248,25 +374,36 @@ def check_and_fill_images(source_directory, destination_directory, number_of_ima
     # Check if destination directory already has desired number of images
     current_images = get_all_images(destination_directory)
     current_count = len(current_images)
-    
-    if current_count >= number_of_images:
-        print(f"Already have {current_count} images in {destination_directory}.")
-        show_images(destination_directory)
-        return
-    
-    print(f"Currently have {current_count} images. Adding more images to reach {number_of_images}...")
-    remaining_images = number_of_images - current_count
+
+    # The source images don't change, so we search them only once (without the ones already in the destination)
+    destination_prefix = os.path.join(os.path.abspath(destination_directory), '')
+    current_names = {os.path.basename(image) for image in current_images}
+    all_images = [
+        image for image in get_all_images(source_directory)
+        if not os.path.abspath(image).startswith(destination_prefix) and os.path.basename(image) not in current_names
+    ]
     
     # Copy additional images until desired count is reached
-    copied_count = copy_images(source_directory, destination_directory, remaining_images)
-    
-    # If images were copied, show them for inspection
-    if copied_count > 0:
-        print(f"Now showing images in {destination_directory} for inspection:")
-        show_images(destination_directory)
-    
-    # Recursive call if number of images is still not reached
-    check_and_fill_images(source_directory, destination_directory, number_of_images)
+    while current_count < number_of_images:
+
+        # Stop if there are no more images to copy
+        if not all_images:
+            print(f"No more images can be added to {destination_directory}.")
+            return
+
+        print(f"Currently have {current_count} images. Adding more images to reach {number_of_images}...")
+        remaining_images = number_of_images - current_count
+        
+        copied_count = copy_images(source_directory, destination_directory, remaining_images, all_images)
+        current_count += copied_count
+        
+        # If images were copied, show them for inspection (the deleted ones have to be replaced)
+        if copied_count > 0:
+            print(f"Now showing images in {destination_directory} for inspection:")
+            current_count -= show_images(destination_directory)
+
+    print(f"Already have {current_count} images in {destination_directory}.")
+    show_images(destination_directory)
 
 if __name__ == "__main__":
     source_directory = "/Volumes/CFElab-1/Data_archive/Images/ISIIS/COOK/Videos2framesdepth/"
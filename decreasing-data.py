@@ -19,7 +19,13 @@ for i, file_name in enumerate(csv_files):
     if i % 10 == 0:  # Select every other file
         source_file_path = os.path.join(source_folder, file_name)
         destination_file_path = os.path.join(destination_folder, file_name)
-        shutil.copyfile(source_file_path, destination_file_path)
+
+        # Hard link the file (only one inode operation), if it is not possible copy it.
+        # The files are not modified, so both paths sharing the same file is not a problem
+        try:
+            os.link(source_file_path, destination_file_path)
+        except OSError:
+            shutil.copyfile(source_file_path, destination_file_path)
         print(f"File '{file_name}' copied to '{destination_folder}'")
 
 print("Copying completed.")
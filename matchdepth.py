@@ -1,36 +1,14 @@
 import pandas as pd
 import re
-from datetime import datetime, timedelta
-import pytz
 from pathlib import Path
 import os
+import io
+import csv
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-def parse_log_date(year, yearday, time_string, timezone):
-    """Parses the log date into a datetime object.
-
-    Args:
-        year (str): year of the data
-        yearday (str): yearday of the data
-        time_string (str): time of the data
-        timezone (str): timezone of the data
-
-    Returns:
-        parsed_datetime: timestamp
-    """    
-    try:
-        # Get the variables
-        date = f'{year}-{yearday.zfill(3)}'
-        time_string = time_string.strip()
-        datetime_str = f'{date} {time_string} {timezone}'
-        parsed_datetime = datetime.strptime(datetime_str, '%Y-%j %H:%M:%S %z')
-
-        # return the timestamp
-        return parsed_datetime
-    
-    except ValueError as e:
-        print(f"Error to parse: {e}")
-        return None
+# Character used to separate the values of the logs before parsing them (the unit separator of ASCII)
+LOG_SEPARATOR = '\x1f'
 
 def filter_time_and_pressure_data(df, filter_columns = False):
     """Filter the DataFrame to show only some columns.
@@ -62,34 +40,21 @@ def filter_time_and_pressure_data(df, filter_columns = False):
 
     # Filter for the columns of preassure (we are intereset in the ctd preassure)
     if filter_columns:
-        filter_columns = time_columns + pressure_columns
+        filtered_df = df[[column for column in time_columns + pressure_columns if column in df.columns]]
     else:
         filtered_df = df
 
-    # Filter values of preassure
-    filtered_df = filtered_df[
-        ~filtered_df['rov_ctd_pressure'].isin(['NO_PUB', 'NO_PROV']) &
-        ~filtered_df['rov_pressure'].isin(['NO_PUB', 'NO_PROV'])
-    ]
+    # Convert the preassure to numbers, the invalid strings (NO_PUB, NO_PROV) become nan.
+    # The spaces around the numbers are accepted, so the values don't have to be stripped in python
+    rov_pressure = pd.to_numeric(filtered_df['rov_pressure'], errors='coerce')
+    rov_ctd_pressure = pd.to_numeric(filtered_df['rov_ctd_pressure'], errors='coerce')
 
-    # Now that the invalid strings are removed, we can safely convert to float and filter by value
-    filtered_df = filtered_df[filtered_df['rov_pressure'].astype(float) > 0]
+    # Filter values of preassure
+    filtered_df = filtered_df[(rov_pressure > 0) & rov_ctd_pressure.notna()]
 
     # Return the filtered dataframe
     return filtered_df
 
-def add_seconds(dt, seconds):
-    """Function to add fractional seconds
-
-    Args:
-        dt(timestamp): time that i want to add some seconds
-        seconds(int): seconds that i want to add
-
-    Returns:
-        dt + timedelta(seconds=seconds): the addition fo the seconds to the timestamp
-    """
-    return dt + timedelta(seconds=seconds)
-
 def find_matching_timestamps(df1, df2, defase= 0, threshold=8):
     """Function to match the timestamps considering a defase of the clocks
     and a minimum threshold in seconds to consider the two timestamps as a match.
@@ -104,69 +69,72 @@ def find_matching_timestamps(df1, df2, defase= 0, threshold=8):
         results: list with the matches
     """
     
-    # Tranforming everything into timestamp
-    df1['timestamp'] = pd.to_datetime(df1['timestamp'], errors='coerce')
-    df2['iso_datetime'] = pd.to_datetime(df2['iso_datetime'], errors='coerce')
-
-    # Timestmaps in UTC
-    df1['timestamp'] = df1['timestamp'].apply(lambda x: x if x.tzinfo else pytz.utc.localize(x))
-    df2['iso_datetime'] = df2['iso_datetime'].apply(lambda x: x if x.tzinfo else pytz.utc.localize(x))
+    # Tranforming everything into timestamp in UTC
+    df1['timestamp'] = pd.to_datetime(df1['timestamp'], errors='coerce', utc=True)
+    df2['iso_datetime'] = pd.to_datetime(df2['iso_datetime'], errors='coerce', utc=True)
     
     # Aplying the defase in the images (their clock runs behind of the ctd in the rov)
-    df2['adjusted_iso_datetime'] = df2['iso_datetime'].apply(lambda x: add_seconds(x, defase))
+    df2['adjusted_iso_datetime'] = df2['iso_datetime'] + pd.Timedelta(seconds=defase)
     
-    # Expanding dimensions to calculate the diferente with matrices 
-    timestamps_img_exp = np.expand_dims(df2['adjusted_iso_datetime'].values, axis=1)  # (m,) -> (m, 1)
-    timestamps_rovctd_ts_exp = np.expand_dims(df1['timestamp'].values, axis=0)  # (n,) -> (1, n)
-    
-    # Absolute diference between the timestamps
-    diff_matrix = np.abs((timestamps_rovctd_ts_exp - timestamps_img_exp).astype('timedelta64[s]').astype(float))
+    # Sorting the ctd timestamps, so the closest one can be found with a binary search
+    df1 = df1.dropna(subset=['timestamp']).sort_values('timestamp').reset_index(drop=True)
+    if df1.empty:
+        return []
 
-    # Get the index of the minimum value for every picture
-    min_indices = np.argmin(diff_matrix, axis=1)
-    
-    # Get the value
-    min_values = np.min(diff_matrix, axis=1)
-    
-    # List of results
-    results = []
+    # Timestamps in nanoseconds
+    timestamps_rovctd_ns = df1['timestamp'].values.astype('datetime64[ns]').view('i8')
+    timestamps_img_ns = df2['adjusted_iso_datetime'].values.astype('datetime64[ns]').view('i8')
+
+    # Position of every picture inside the sorted ctd timestamps
+    positions = np.searchsorted(timestamps_rovctd_ns, timestamps_img_ns)
+
+    # The closest timestamp is the one before or the one after that position
+    right_indices = np.clip(positions, 0, len(timestamps_rovctd_ns) - 1)
+    left_indices = np.clip(positions - 1, 0, len(timestamps_rovctd_ns) - 1)
+    diff_right = np.abs(timestamps_rovctd_ns[right_indices] - timestamps_img_ns)
+    diff_left = np.abs(timestamps_rovctd_ns[left_indices] - timestamps_img_ns)
+
+    # Get the index and the value of the minimum difference for every picture
+    min_indices = np.where(diff_left <= diff_right, left_indices, right_indices)
+    min_values = np.minimum(diff_left, diff_right)
 
     # Apply the threshold to consider the match
-    for i, min_idx in enumerate(min_indices):
-        if min_values[i] <= threshold:
-            ts_rovctd = df2.iloc[i]['iso_datetime']
-
-            # The name of the pressure dependes of the data
-            if raw:
-                depth_rovctd = df1.iloc[min_idx]['rov_ctd_pressure'].strip()
-            else:
-                depth_rovctd = df1.iloc[min_idx]['depth']
-            ts_img = df1.iloc[min_idx]['timestamp']
-            img_path = df2.iloc[i]['path']
-
-            # Add the matches to the results
-            results.append((ts_img, depth_rovctd, ts_rovctd, img_path))
-    
+    matched = np.flatnonzero((min_values <= threshold * 1e9) & df2['adjusted_iso_datetime'].notna().values)
+    matched_rows = min_indices[matched]
+
+    # The name of the pressure dependes of the data
+    if raw:
+        depths_rovctd = df1['rov_ctd_pressure'].iloc[matched_rows].str.strip()
+    else:
+        depths_rovctd = df1['depth'].iloc[matched_rows]
+
+    # List of results
+    results = list(zip(
+        df1['timestamp'].iloc[matched_rows],
+        depths_rovctd,
+        df2['iso_datetime'].iloc[matched],
+        df2['path'].iloc[matched]
+    ))
+
     # Return the results of the matches
     return results
 
-# Create a 'timestamp' column by combining 'rovCtdDtg' and 'usec'
-def create_timestamp(row):
-    """Create a 'timestamp' column by combining 'rovCtdDtg' and 'usec'
+def rename_image(path, new_path):
+    """Rename an image without stopping if there is an error
+
     Args:
-        row (dataframe): data frame 
+        path (str): current path of the image
+        new_path (str): new path of the image
 
     Returns:
-        dt: the data frame with the new row
+        error: the error if the image could not be renamed, otherwise None
     """
-    
-    # Convert 'rovCtdDtg' to a datetime object in GMT
-    dt = datetime.strptime(row['rovCtdDtg'], '%m/%d/%Y %H:%M:%S')
-    # Localize to GMT
-    dt = pytz.timezone('GMT').localize(dt)
 
-    # Return the dataframe
-    return dt
+    try:
+        os.replace(path, new_path)
+        return None
+    except Exception as e:
+        return e
 
 def parse_log_file_to_dataframe(file_path):
     """Parses the log file into a DataFrame. Remember that this function is only when the 
@@ -200,50 +168,32 @@ def parse_log_file_to_dataframe(file_path):
     column_names += ["year", "yearday", "time", "timezone"]
 
     # Filter the columns that not start with #
-    log_entries = [line.strip() for line in lines if not line.startswith('#')]
-
-    # Separate the data into columns
-    parsed_entries = []
-    errors = []
-
-    # Transform the data
-    for entry in log_entries:
-        data = entry.split(', ')
-        if len(data) >= 20:
-            try:
-                # Extract and parse the date
-                year = data[16]
-                yearday = data[17]
-                time_string = data[18]
-                timezone = data[19]
-                parsed_datetime = parse_log_date(year, yearday, time_string, timezone)
-                
-                if parsed_datetime:
-                    # Add the parsed_datetime
-                    data.append(str(parsed_datetime))
-                else:
-                    data.append(np.nan)
-                
-                parsed_entries.append(data)
-            except IndexError:
-                errors.append(entry)
-        else:
-            errors.append(entry)
+    log_entries = pd.Series([line.strip() for line in lines if not line.startswith('#')], dtype='string')
+
+    # The lines need at least 20 values to have the date
+    valid_entries = log_entries.str.count(', ') + 1 >= 20
+    errors = log_entries[~valid_entries]
 
     # Print lines with errors
-    if errors:
+    if not errors.empty:
         print("Lines with errors:")
         for error in errors:
             print(error)
 
-    # Get sure that the rows has teh perfect number of columns
-    for i, data in enumerate(parsed_entries):
-        if len(data) < len(column_names) + 1:
-            # Complete with nan
-            parsed_entries[i] = data + [np.nan] * (len(column_names) + 1 - len(data))
+    # Separate the data into columns with the C parser of pandas, the missing values are completed with nan.
+    # The values are separated by ', ' (a value can have a comma inside), so it is changed to a character 
+    # that is never in the logs and the C parser splits on it
+    body = '\n'.join(log_entries[valid_entries].str.replace(', ', LOG_SEPARATOR, regex=False))
+    if body:
+        df = pd.read_csv(io.StringIO(body), sep=LOG_SEPARATOR, engine='c',
+                         names=column_names, header=None, index_col=False, dtype=str, quoting=csv.QUOTE_NONE)
+    else:
+        df = pd.DataFrame(columns=column_names, dtype=str)
 
-    # Create Dataframe
-    df = pd.DataFrame(parsed_entries, columns=column_names + ["parsed_datetime"])
+    # Extract and parse the date (year, yearday, time and timezone are the values 16 to 19)
+    year, yearday, time_string, timezone = (df.iloc[:, i].fillna('') for i in range(16, 20))
+    datetime_str = year + '-' + yearday.str.zfill(3) + ' ' + time_string.str.strip() + ' ' + timezone.str.strip()
+    df['parsed_datetime'] = pd.to_datetime(datetime_str, format='%Y-%j %H:%M:%S %z', errors='coerce', utc=True)
 
     # Tranform to the correct data type
     df['loghost_system_utc'] = pd.to_numeric(df['loghost_system_utc'], errors='coerce')
@@ -279,7 +229,9 @@ images_dir_path = "/Volumes/CFElab-1/Data_archive/Images/ISIIS/COOK/Videos2frame
 if not raw:
     # Read the text file into a DataFrame
     df = pd.read_csv(file_path)
-    df['timestamp'] = df.apply(create_timestamp, axis=1)
+
+    # Create a 'timestamp' column from 'rovCtdDtg' in GMT
+    df['timestamp'] = pd.to_datetime(df['rovCtdDtg'], format='%m/%d/%Y %H:%M:%S', utc=True)
 else:
     # Ejecutar la función para crear el DataFrame
     df = parse_log_file_to_dataframe(file_path)
@@ -290,45 +242,33 @@ else:
 # Regular expression to extract data from the filename
 pattern = re.compile(r"CFE_(.*?)-(\d+)-(\d{4}-\d{2}-\d{2} \d{2}-\d{2}-\d{2}\.\d{3})_(\d{4})")
 
-# Initialize dictionaries and variables
-iso_datetime = {}
-instrument_type = {}
-path = {}
-index = 0
-
-# Iterate over files in the folder and subfolders
-for root, dirs, files in os.walk(images_dir_path):
-    for file in files:
-        if file.endswith('.jpg'):
-            # Extract data from the filename using the regular expression
-            matches = re.findall(pattern, file)
-            if matches:
-                instrument, _, datetime_str, frame_num = matches[0]
-                datetime_str = datetime_str.replace('-', ':') + "Z"  # Replace hyphens with colons and add Z for UTC
-                
-                # Convert datetime string to datetime object
-                dt = datetime.strptime(datetime_str, "%Y:%m:%d %H:%M:%S.%fZ")
-    
-                # Add the seconds
-                dt = add_seconds(dt, float(frame_num))
-    
-                # Localize to PST
-                dt = pytz.timezone('America/Los_Angeles').localize(dt)
+# Get the images in the folder and subfolders
+image_files = pd.DataFrame(
+    [(os.path.join(root, file), file) for root, _, files in os.walk(images_dir_path) for file in files if file.endswith('.jpg')],
+    columns=['path', 'name']
+)
 
-                #dt = dt - timedelta(hours=1)
+# Extract data from the filename using the regular expression (instrument, _, datetime, frame number)
+extracted = image_files['name'].str.extract(pattern)
+matched = extracted[0].notna()
+extracted = extracted[matched].reset_index(drop=True)
 
-                # Convert to UTC
-                dt_utc = dt.astimezone(pytz.utc)
-                iso_datetime[index] = dt_utc
-                instrument_type[index] = instrument
-                path[index] = os.path.join(root, file)
-                index += 1
+# Convert datetime string to datetime object and add the seconds of the frame
+dt = pd.to_datetime(extracted[2], format='%Y-%m-%d %H-%M-%S.%f') + pd.to_timedelta(extracted[3].astype(int), unit='s')
 
-# Convert dictionaries to a DataFrame
+# Localize to PST (the ambiguous times are considered standard time) and convert to UTC
+dt_utc = dt.dt.tz_localize('America/Los_Angeles', ambiguous=np.zeros(len(dt), dtype=bool),
+                           nonexistent='NaT').dt.tz_convert('UTC')
+
+# The times that don't exist (the hour skipped in spring) are also read as standard time (UTC-8), as pytz did
+nonexistent = dt_utc.isna() & dt.notna()
+dt_utc[nonexistent] = (dt[nonexistent] + pd.Timedelta(hours=8)).dt.tz_localize('UTC')
+
+# Create the DataFrame of the images
 iso_datetime_df = pd.DataFrame({
-    'iso_datetime': pd.Series(iso_datetime),
-    'instrument_type': pd.Series(instrument_type),
-    'path': pd.Series(path)
+    'iso_datetime': dt_utc,
+    'instrument_type': extracted[0],
+    'path': image_files['path'][matched].reset_index(drop=True)
 })
 
 # Matching the timestamps
@@ -343,32 +283,26 @@ if verbose:
     print(f"Summary: {len(matching_timestamps)} matches out of {len(iso_datetime_df)} images")
 
 if rename:
-    # Show matching timestamps
-    print("Matching timestamps:")
-    for ts1, depth, ts2, path in matching_timestamps:
-        try:
-            # Split the original file name and extension
-            original_name, extension = os.path.splitext(os.path.basename(path))
-            
-            # Skip images whose name ends with 'm'
-            if original_name.endswith('m'):
-                print(f"Skipping {path} as it ends with 'm'")
-                continue
-            
-            print(f"ROV: {ts1} - Instrument: {ts2} at depth {depth} with path {path}")
-            suffix = f'_{depth}m'  # Replace with the actual value you want to add
-
-            # Create the new file name with the suffix
-            new_file_name = f'{original_name}{suffix}{extension}'
-
-            # Build the full new file path
-            new_file_path = os.path.join(os.path.dirname(path), new_file_name)
-
-            # Rename the file
-            os.rename(path, new_file_path)
-
-            print(f'Renamed {path} to {new_file_path}')
-        except Exception as e:
-            print(f'Error renaming {path} to {new_file_path}: {e}')
+    # Images to rename, skipping the images whose name ends with 'm' (they already have the depth)
+    to_rename = [
+        (path, depth) for _, depth, _, path in matching_timestamps
+        if not os.path.splitext(os.path.basename(path))[0].endswith('m')
+    ]
+    print(f"Skipping {len(matching_timestamps) - len(to_rename)} images that already end with 'm'")
+
+    # Create the new file names with the depth as suffix
+    old_paths = [path for path, _ in to_rename]
+    new_paths = [f'{os.path.splitext(path)[0]}_{depth}m{os.path.splitext(path)[1]}' for path, depth in to_rename]
+
+    # Rename the files with several threads, so the filesystem operations overlap
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        errors = list(executor.map(rename_image, old_paths, new_paths))
+
+    # Show the renamed images
+    for old_path, new_path, error in zip(old_paths, new_paths, errors):
+        if error is not None:
+            print(f'Error renaming {old_path} to {new_path}: {error}')
+        elif verbose:
+            print(f'Renamed {old_path} to {new_path}')
 
     print(f"Summary: {len(matching_timestamps)} matches out of {len(iso_datetime_df)} images")
@@ -1,8 +1,74 @@
 import cv2
 import os
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 
+# Avoid the OpenMP threads of OpenCV inside the multiprocessing workers
+cv2.setNumThreads(0)
+
+# When ffmpeg is installed the frames are extracted with it, otherwise with OpenCV
+FFMPEG_PATH = shutil.which('ffmpeg')
+
+# Threads used by every ffmpeg process
+FFMPEG_THREADS = 2
+
+def extract_frames_ffmpeg(video_path, output_dir, frame_rate):
+    """This function is to extract frames of a video with ffmpeg, which decodes 
+    and encodes the frames without going through python
+
+    Args:
+        video_path (str): path to the videos
+        output_dir (str): path to the folder that you want to save the frames   
+        frame_rate (int): frame rate to obtain the frames
+
+    Returns:
+        ok: True if ffmpeg finished without errors
+    """    
+
+    # Getting the videos
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+
+    # Frames with the same names as the ones saved with OpenCV.
+    # The decoder (-threads before -i), the filters and the encoder (-threads after -i) use FFMPEG_THREADS each
+    frame_pattern = os.path.join(output_dir, f"{video_name}_%04d.jpg")
+    cmd = [
+        FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-nostdin',
+        '-filter_threads', str(FFMPEG_THREADS),
+        '-threads', str(FFMPEG_THREADS),
+        '-i', video_path,
+        '-vf', f'fps={frame_rate}',
+        '-q:v', '2',
+        '-threads', str(FFMPEG_THREADS),
+        '-start_number', '0',
+        frame_pattern
+    ]
+
+    # A broken video only stops its own extraction, the errors of ffmpeg are shown to know why
+    result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            text=True, errors='replace')
+    if result.returncode != 0:
+        print(f"Error extracting frames from {video_path}: {result.stderr.strip()}")
+        return False
+    return True
+
+def save_frame(frame, frame_path):
+    """This function encodes a frame in jpg and writes it to the disk
+
+    Args:
+        frame (ndarray): frame of the video
+        frame_path (str): path of the new image
+    """    
+
+    # Encode the frame in memory and write the bytes at once
+    ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        raise ValueError(f"Could not encode the frame {frame_path}")
+    encoded.tofile(frame_path)
+
 def extract_frames(video_path, output_dir, frame_rate):
     """This function is to extract frames of a video in avi format with 
     a desired frame rate
@@ -23,29 +89,50 @@ def extract_frames(video_path, output_dir, frame_rate):
     print(f"Processing video: {video_name}")
     print(f"Output directory: {output_dir}")
 
+    # Use ffmpeg if it is installed
+    if FFMPEG_PATH:
+        if extract_frames_ffmpeg(video_path, output_dir, frame_rate):
+            print(f"Extraction completed for {video_name}.")
+        return
+
     # Read the videos 
     cap = cv2.VideoCapture(video_path)
     fps = int(cap.get(cv2.CAP_PROP_FPS))
-    frame_interval = fps // frame_rate
+    frame_interval = max(1, fps // frame_rate)
 
     
     count = 0
     saved_frames = 0
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    # Frames that are being saved, the encoding and writing is done in other threads 
+    # while the video is decoded (at most 8 frames are waiting to be saved)
+    pending = deque()
+
     # Looping into the videos to get the frames
-    with tqdm(total=total_frames, desc=f"Extracting frames from {video_name}", unit="frame") as pbar:
+    with ThreadPoolExecutor(max_workers=2) as writer, \
+            tqdm(total=total_frames, desc=f"Extracting frames from {video_name}", unit="frame") as pbar:
         while cap.isOpened():
-            ret, frame = cap.read()
+            # Only read the frame, it is decoded only if we are going to save it
+            ret = cap.grab()
             if not ret:
                 break
             if count % frame_interval == 0:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
                 frame_name = f"{video_name}_{saved_frames:04d}.jpg"
                 frame_path = os.path.join(output_dir, frame_name)
-                cv2.imwrite(frame_path, frame)
+                pending.append(writer.submit(save_frame, frame, frame_path))
+                if len(pending) > 8:
+                    pending.popleft().result()
                 saved_frames += 1
             count += 1
             pbar.update(1)
+
+        # Wait for the last frames
+        while pending:
+            pending.popleft().result()
     
     cap.release()
     print(f"Extraction completed for {video_name}. {saved_frames} frames saved.")
@@ -74,35 +161,49 @@ def process_video_file(params):
     # Extract the frames
     extract_frames(video_path, output_dir, frame_rate)
 
-def process_videos(input_dir, output_dir):
-    """This function loops into all the videos to transform them to frames
+def find_video_files(input_dir, output_dir, frame_rate):
+    """This function loops into the folders to get the videos to transform, 
+    giving every video as soon as it is found
 
     Args:
         input_dir (str): path which contains all the videos in avi
         output_dir (str): path to the new videos in frames
-    """    
+        frame_rate (int): frame rate to obtain the frames
 
-    # List with the video files
-    video_files = []
+    Yields:
+        params: parameters of process_video_file for every video
+    """    
 
-    # Looping into the folders to get the videos to tranform
-    print("Scanning for video files...")
-    for root, dirs, files in tqdm(os.walk(input_dir), desc="Walking through directories"):
+    for root, _, files in os.walk(input_dir):
         for filename in files:
             if filename.endswith(".avi"):
                 video_path = os.path.join(root, filename)
-                video_files.append((video_path, output_dir, input_dir))
-    print(f"Found {len(video_files)} video files to process.")
+                yield (video_path, output_dir, frame_rate, input_dir)
+
+def process_videos(input_dir, output_dir, frame_rate=1):
+    """This function loops into all the videos to transform them to frames
+
+    Args:
+        input_dir (str): path which contains all the videos in avi
+        output_dir (str): path to the new videos in frames
+        frame_rate (int, optional): frame rate to obtain the frames. Defaults to 1.
+    """    
 
-    # Using the cores of the computer
-    num_cores = cpu_count() - 1
+    # Using the cores of the computer (ffmpeg uses several threads for every video)
+    if FFMPEG_PATH:
+        num_cores = max(1, cpu_count() // FFMPEG_THREADS)
+    else:
+        num_cores = max(1, cpu_count() - 1)
     print(f"Using {num_cores} cores for parallel processing.")
 
-    # Tranforming the videos
-    print("Starting conversion and frame extraction...")
+    # Tranforming the videos while they are being found
+    print("Scanning for video files and starting frame extraction...")
+    processed = 0
     with Pool(num_cores) as pool:
-        list(tqdm(pool.imap(process_video_file, video_files), total=len(video_files), desc="Processing videos"))
-    print("Conversion and frame extraction completed.")
+        video_files = find_video_files(input_dir, output_dir, frame_rate)
+        for _ in tqdm(pool.imap_unordered(process_video_file, video_files, chunksize=1), desc="Processing videos"):
+            processed += 1
+    print(f"Frame extraction completed for {processed} video files.")
 
 if __name__ == "__main__":
     input_directory = "/Volumes/CFElab/Data_archive/Images/ISIIS/RAW/20240821_RachelCarson/"
@@ -1,15 +1,333 @@
 import cv2
 import os
-import ffmpeg
+import re
+import shutil
+import asyncio
+import platform
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 
-def convert_avi_to_mp4(video_path, output_dir):
+# PyAV is optional, it converts the videos inside python instead of starting ffmpeg for every batch
+try:
+    import av
+except ImportError:
+    av = None
+
+# Cache of the encoders of ffmpeg (None until ffmpeg is asked)
+_ENCODERS = None
+
+# Cache of the NVENC probe (None until ffmpeg is asked)
+_HAS_NVENC = None
+
+# Cache of the NVIDIA decoders of ffmpeg (None until ffmpeg is asked)
+_CUVID_DECODERS = None
+
+# Video codecs that can be copied into mp4 without encoding them again
+COPY_CODECS = {'h264', 'hevc', 'mpeg4'}
+
+# Names of the cuvid decoders that are different from the name of the codec
+CUVID_NAMES = {'mpeg2video': 'mpeg2', 'mpeg1video': 'mpeg1'}
+
+# Encoders for archiving, the videos are always encoded with them to make the files smaller
+ARCHIVE_CODECS = {'libsvtav1', 'libx265'}
+
+# Used to pin every ffmpeg to its own cores (only in Linux)
+TASKSET_PATH = shutil.which('taskset')
+
+# The new videos are written with this suffix and renamed when they are complete, so an interrupted run 
+# doesn't leave half videos that are taken as converted in the next one
+PART_SUFFIX = '.part'
+
+# Maximum number of videos of the same folder converted by one ffmpeg process
+BATCH_SIZE = 8
+
+# Video streams in the description of the inputs of ffmpeg ("Stream #<input>:<stream>...: Video: <codec>")
+STREAM_PATTERN = re.compile(r'Stream #(\d+):\d+\S*: Video: (\w+)')
+
+def get_encoders():
+    """This function checks once which encoders ffmpeg has
+
+    Returns:
+        encoders: names of the encoders (like libx264)
+    """    
+
+    global _ENCODERS
+    if _ENCODERS is None:
+        try:
+            encoders = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-encoders'],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True
+            ).stdout
+            _ENCODERS = set(re.findall(r'^\s*[VAS]\S*\s+(\w+)', encoders, re.MULTILINE))
+        except (OSError, subprocess.CalledProcessError):
+            _ENCODERS = set()
+    return _ENCODERS
+
+def has_nvenc():
+    """This function checks once if ffmpeg can encode with NVENC in an NVIDIA GPU
+
+    Returns:
+        has_nvenc: True if h264_nvenc can be used
+    """    
+
+    global _HAS_NVENC
+    if _HAS_NVENC is None:
+        _HAS_NVENC = False
+
+        # Many builds of ffmpeg list h264_nvenc without a GPU, so one frame is encoded to be sure
+        if 'h264_nvenc' in get_encoders():
+            try:
+                subprocess.run(
+                    ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin',
+                     '-f', 'lavfi', '-i', 'color=s=256x256', '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=30
+                )
+                _HAS_NVENC = True
+            except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                pass
+    return _HAS_NVENC
+
+def has_videotoolbox():
+    """This function checks once if ffmpeg has the VideoToolbox encoder of macOS
+
+    Returns:
+        has_videotoolbox: True if h264_videotoolbox can be used
+    """    
+
+    return platform.system() == 'Darwin' and 'h264_videotoolbox' in get_encoders()
+
+def default_codec():
+    """This function chooses the fastest encoder of this computer: the NVIDIA GPU, 
+    then the media engine of the Mac and then the CPU
+
+    Returns:
+        codec: name of the ffmpeg encoder
+    """    
+
+    if has_nvenc():
+        return 'h264_nvenc'
+    if has_videotoolbox():
+        return 'h264_videotoolbox'
+    return 'libx264'
+
+def get_cuvid_decoders():
+    """This function checks once which codecs ffmpeg can decode in the NVIDIA GPUs
+
+    Returns:
+        decoders: names of the cuvid decoders (like h264_cuvid)
+    """    
+
+    global _CUVID_DECODERS
+    if _CUVID_DECODERS is None:
+        try:
+            decoders = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-decoders'],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True
+            ).stdout
+            _CUVID_DECODERS = set(re.findall(r'\b(\w+_cuvid)\b', decoders))
+        except (OSError, subprocess.CalledProcessError):
+            _CUVID_DECODERS = set()
+    return _CUVID_DECODERS
+
+def scan_directory(directory, extension):
+    """This function reads one directory, separating the files with the extension and the subdirectories.
+    The type of every entry comes from the directory listing, without an extra stat per file
+
+    Args:
+        directory (str): path of the directory
+        extension (str): extension of the files that we want
+
+    Returns:
+        files: paths of the files with the extension
+        subdirs: paths of the subdirectories
+    """    
+
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(extension) and entry.is_file():
+                    files.append(entry.path)
+    except OSError as e:
+        print(f"Error reading {directory}: {e}")
+    return files, subdirs
+
+def scan_files(directory, extension, max_workers=32):
+    """This function recursively gets the files with the extension, reading several directories 
+    at the same time so the network round trips of a remote volume overlap
+
+    Args:
+        directory (str): path of the directory
+        extension (str): extension of the files that we want
+        max_workers (int, optional): number of directories read at the same time. Defaults to 32.
+
+    Returns:
+        files: paths of the files with the extension
+    """    
+
+    # The progress bar is only drawn every 100 directories or every second, 
+    # otherwise writing to the terminal takes time for every directory
+    files = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(desc="Walking through directories", miniters=100, mininterval=1.0) as pbar:
+        pending = {executor.submit(scan_directory, directory, extension)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, subdirs = future.result()
+                files.extend(dir_files)
+
+                # Read the subdirectories
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan_directory, subdir, extension))
+                pbar.update(1)
+    return files
+
+def get_video_codecs(video_paths):
+    """This function gets the codec of the first video stream of several files, 
+    opening all of them with only one ffmpeg process
+
+    Args:
+        video_paths (list): Paths to the videos
+
+    Returns:
+        codec_names: name of the codec of every video, None if it could not be read
+    """    
+
+    # Without outputs ffmpeg only describes the inputs (and exits with an error)
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin']
+    for video_path in video_paths:
+        cmd += ['-i', video_path]
+    try:
+        result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                text=True, errors='replace')
+    except OSError:
+        return [None] * len(video_paths)
+
+    # Lines like "Stream #1:0: Video: h264 ...", the first number is the input
+    codec_names = [None] * len(video_paths)
+    for input_index, codec_name in STREAM_PATTERN.findall(result.stderr):
+        input_index = int(input_index)
+        if input_index < len(codec_names) and codec_names[input_index] is None:
+            codec_names[input_index] = codec_name
+    return codec_names
+
+def get_video_codec(video_path):
+    """This function gets the codec of the video stream of a file
+
+    Args:
+        video_path (str): Path to the video
+
+    Returns:
+        codec_name: name of the codec, None if it could not be read
+    """    
+
+    return get_video_codecs([video_path])[0]
+
+def build_ffmpeg_batch_command(videos, codec=None, preset='veryfast', threads=0, hwaccel=True):
+    """This function builds one ffmpeg command to transform several avi videos into mp4 format, 
+    so the start of ffmpeg is paid only once
+
+    Args:
+        videos (list): tuples with the path to the video in avi and the path to the new video in mp4
+        codec (str, optional): 'h264_nvenc' to encode in the GPU, 'h264_videotoolbox' or 'hevc_videotoolbox'
+                               to encode in the media engine of a Mac or 'libx264' to encode in the CPU,
+                               if None the fastest one that is available is used. For archiving, 'libsvtav1'
+                               or 'libx265' make files 30-50% smaller but take longer to encode. Defaults to None.
+        preset (str, optional): preset of libx264 and libx265, the faster ones skip the slow motion estimation 
+                                and trellis features. Defaults to 'veryfast'.
+        threads (int, optional): number of threads of ffmpeg, divided between the decoders and between the 
+                                 encoders of the videos (at least one each, so with more videos than threads 
+                                 ffmpeg uses more threads). With 0 the encoder chooses (1.5 threads per core 
+                                 in libx264). Defaults to 0.
+        hwaccel (bool, optional): decode in the GPU when encoding with NVENC. Defaults to True.
+
+    Returns:
+        cmd: list with the arguments of the ffmpeg command
+    """    
+
+    # Choose the encoder
+    if codec is None:
+        codec = default_codec()
+
+    # If the avi already has a codec supported by mp4, the video is copied without encoding it
+    # (the codec is also needed to decode in the GPU)
+    if codec in ARCHIVE_CODECS:
+        input_codecs = [None] * len(videos)
+    else:
+        input_codecs = get_video_codecs([video_path for video_path, _ in videos])
+
+    # The threads are divided between the videos, every decoder and every encoder gets its part
+    video_threads = max(1, threads // len(videos)) if threads else 0
+
+    # Only the errors are written by ffmpeg, and it never waits for the keyboard
+    cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for (video_path, _), input_codec in zip(videos, input_codecs):
+
+        # With NVENC the videos are also decoded in the GPU, so the frames never leave its memory
+        decoder = f"{CUVID_NAMES.get(input_codec, input_codec)}_cuvid"
+        if hwaccel and codec == 'h264_nvenc' and input_codec not in COPY_CODECS and decoder in get_cuvid_decoders():
+            cmd += ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda', '-c:v', decoder]
+        cmd += ['-threads', str(video_threads), '-i', video_path]
+
+    # Every output takes the video and audio of its own input
+    for index, ((_, output_mp4), input_codec) in enumerate(zip(videos, input_codecs)):
+        cmd += ['-map', f'{index}:v:0', '-map', f'{index}:a:0?']
+
+        if input_codec in COPY_CODECS:
+            cmd += ['-c:v', 'copy', '-c:a', 'aac']
+            if input_codec == 'hevc':
+                cmd += ['-tag:v', 'hvc1']
+
+        # Convert AVI to MP4
+        elif codec == 'h264_nvenc':
+            cmd += ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'hq', '-rc', 'vbr', '-cq', '23', '-b:v', '0']
+        elif codec in ('h264_videotoolbox', 'hevc_videotoolbox'):
+            cmd += ['-c:v', codec, '-b:v', '6M', '-allow_sw', '1', '-realtime', '0']
+            if codec == 'hevc_videotoolbox':
+                cmd += ['-tag:v', 'hvc1']
+        elif codec == 'libsvtav1':
+            cmd += ['-c:v', 'libsvtav1', '-preset', '8', '-crf', '30', '-pix_fmt', 'yuv420p10le']
+        elif codec == 'libx265':
+            cmd += ['-c:v', 'libx265', '-preset', preset, '-crf', '28', '-tag:v', 'hvc1']
+        else:
+            cmd += ['-c:v', 'libx264', '-preset', preset, '-crf', '23', '-tune', 'fastdecode']
+
+        # The moov atom goes at the beginning of the file, so the videos can be played before they are downloaded
+        # (the format is given because the output can end in PART_SUFFIX)
+        cmd += ['-threads', str(video_threads), '-movflags', '+faststart', '-f', 'mp4', output_mp4]
+    return cmd
+
+def build_ffmpeg_command(video_path, output_mp4, codec=None, preset='veryfast', threads=0):
+    """This function builds the ffmpeg command to transform an avi video into mp4 format
+
+    Args:
+        video_path (str): Path to the video in avi
+        output_mp4 (str): Path to the new video in mp4
+        codec (str, optional): encoder of the videos, see build_ffmpeg_batch_command. Defaults to None.
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
+        threads (int, optional): number of threads of ffmpeg, see build_ffmpeg_batch_command. Defaults to 0.
+
+    Returns:
+        cmd: list with the arguments of the ffmpeg command
+    """    
+
+    return build_ffmpeg_batch_command([(video_path, output_mp4)], codec, preset, threads)
+
+def convert_avi_to_mp4(video_path, output_dir, codec=None, preset='veryfast'):
     """This function transforms avi videos into mp4 format
 
     Args:
         video_path (str): Path to the videos in avi
         output_dir (str): Path to the new videos in mp4
+        codec (str, optional): encoder of the videos, see build_ffmpeg_batch_command. Defaults to None.
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
     """    
 
     video_name = os.path.splitext(os.path.basename(video_path))[0]
@@ -19,61 +337,371 @@ def convert_avi_to_mp4(video_path, output_dir):
     if os.path.exists(output_mp4):
         return output_mp4
 
-    # Convert AVI to MP4
-    ffmpeg.input(video_path).output(output_mp4, vcodec='libx264').run()
+    # Convert AVI to MP4 (written with PART_SUFFIX until it is complete)
+    subprocess.run(build_ffmpeg_command(video_path, f"{output_mp4}{PART_SUFFIX}", codec, preset), 
+                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    os.replace(f"{output_mp4}{PART_SUFFIX}", output_mp4)
     return output_mp4
 
-def process_video_file(params):
-    """This function creates the path to the new videos in mp4 and
-    call the function to tranform the videos.
+def convert_video_pyav(video_path, output_mp4, preset='veryfast', threads=0):
+    """This function transforms an avi video into mp4 format with PyAV (libx264), 
+    decoding and encoding it inside python. Only the video is kept.
+
+    Args:
+        video_path (str): Path to the video in avi
+        output_mp4 (str): Path to the new video in mp4
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
+        threads (int, optional): number of threads of the decoder and the encoder, with 0 they choose. Defaults to 0.
+    """    
+
+    # Same mp4 options as build_ffmpeg_batch_command (faststart)
+    with av.open(video_path) as container_in, \
+            av.open(output_mp4, 'w', format='mp4', options={'movflags': '+faststart'}) as container_out:
+        if not container_in.streams.video:
+            raise ValueError(f"{video_path} has no video")
+        in_stream = container_in.streams.video[0]
+        in_stream.thread_type = 'AUTO'
+        in_stream.codec_context.thread_count = threads
+
+        # Same settings as the libx264 command of ffmpeg
+        out_stream = container_out.add_stream('libx264', rate=in_stream.average_rate or in_stream.guessed_rate)
+        out_stream.width = in_stream.codec_context.width
+        out_stream.height = in_stream.codec_context.height
+        out_stream.pix_fmt = 'yuv420p'
+        out_stream.thread_count = threads
+        out_stream.options = {'preset': preset, 'crf': '23', 'tune': 'fastdecode'}
+
+        for packet in container_in.demux(in_stream):
+            for frame in packet.decode():
+                container_out.mux(out_stream.encode(frame))
+
+        # Frames that are still in the encoder
+        container_out.mux(out_stream.encode())
+
+async def run_pyav(videos, threads, preset='veryfast'):
+    """This function transforms some videos with PyAV in another thread, removing the 
+    incomplete files if it fails
+
+    Args:
+        videos (list): tuples with the path to the video in avi and the path to the new video in mp4
+        threads (int): number of threads of the decoder and the encoder
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
+
+    Returns:
+        failed: videos that could not be transformed
+    """    
+
+    failed = []
+    for video_path, output_mp4 in videos:
+        try:
+            # The decoding and encoding release the GIL, so the workers run at the same time
+            await asyncio.to_thread(convert_video_pyav, video_path, f"{output_mp4}{PART_SUFFIX}", preset, threads)
+            os.replace(f"{output_mp4}{PART_SUFFIX}", output_mp4)
+        # Any error (like an avi without video) only stops this video, as with ffmpeg
+        except Exception:
+            if os.path.exists(f"{output_mp4}{PART_SUFFIX}"):
+                os.remove(f"{output_mp4}{PART_SUFFIX}")
+            failed.append((video_path, output_mp4))
+    return failed
+
+async def run_ffmpeg(videos, codec, threads, cores=None, preset='veryfast', hwaccel=True):
+    """This function runs one ffmpeg process to transform some videos, removing the 
+    incomplete files if it fails
+
+    Args:
+        videos (list): tuples with the path to the video in avi and the path to the new video in mp4
+        codec (str): encoder of the videos
+        threads (int): number of threads of the ffmpeg process
+        cores (list, optional): cores where ffmpeg and all its threads run, if None any core. Defaults to None.
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
+        hwaccel (bool, optional): decode in the GPU when encoding with NVENC. Defaults to True.
+
+    Returns:
+        ok: True if ffmpeg finished without errors
+    """    
+
+    # ffmpeg writes with PART_SUFFIX and the videos are renamed when all of them are complete
+    part_videos = [(video_path, f"{output_mp4}{PART_SUFFIX}") for video_path, output_mp4 in videos]
+
+    # Probing the videos runs ffmpeg, so it is done outside of the event loop
+    cmd = await asyncio.to_thread(build_ffmpeg_batch_command, part_videos, codec, preset, threads, hwaccel)
+
+    # Pinning ffmpeg to its cores from the start, so its threads keep their caches
+    if cores:
+        cmd = [TASKSET_PATH, '-c', ','.join(str(core) for core in cores)] + cmd
+
+    # Convert AVI to MP4 and save it in the output directory (nothing is read from the pipes, so they can't get full)
+    process = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    if await process.wait() == 0:
+        for (_, part_mp4), (_, output_mp4) in zip(part_videos, videos):
+            os.replace(part_mp4, output_mp4)
+        return True
+
+    # Remove the incomplete files, so they are converted again in the next run
+    for _, part_mp4 in part_videos:
+        if os.path.exists(part_mp4):
+            os.remove(part_mp4)
+    return False
+
+async def process_video_batch(batch, codec, threads, cores=None, backend='ffmpeg', preset='veryfast'):
+    """This function runs ffmpeg to tranform a batch of videos of the same folder.
+
+    Args:
+        batch (list): paths of the videos to transform and of the new videos in mp4
+        codec (str): name of the ffmpeg encoder
+        threads (int): number of threads of the ffmpeg process
+        cores (list, optional): cores where ffmpeg runs, if None any core. Defaults to None.
+        backend (str, optional): 'ffmpeg' or 'pyav', see process_videos. Defaults to 'ffmpeg'.
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
+
+    Returns:
+        failed: videos of the batch that could not be transformed
+    """    
+
+    # PyAV converts the videos one by one
+    if backend == 'pyav':
+        return await run_pyav(batch, threads, preset)
+
+    failed = []
+    if not await run_ffmpeg(batch, codec, threads, cores, preset):
+        for video in batch:
+
+            # If one video of the batch fails ffmpeg stops, so every video is tried alone
+            if len(batch) > 1 and await run_ffmpeg([video], codec, threads, cores, preset):
+                continue
+
+            # The GPU decoders don't support every video (like monochrome or 4:2:2 MJPEG), so it is decoded in the CPU
+            if codec == 'h264_nvenc' and await run_ffmpeg([video], codec, threads, cores, preset, hwaccel=False):
+                continue
+            failed.append(video)
+
+    return failed
+
+def download_video(video_path, scratch_dir):
+    """This function copies a video to the local scratch folder
+
+    Args:
+        video_path (str): path to the video in avi
+        scratch_dir (str): local folder of this worker
+
+    Returns:
+        local_avi: path to the local copy of the video, None if it could not be copied
+    """    
+
+    # Every copy gets a new name, two folders can have videos with the same name
+    local_avi = None
+    try:
+        fd, local_avi = tempfile.mkstemp(suffix='.avi', dir=scratch_dir)
+        os.close(fd)
+        shutil.copyfile(video_path, local_avi)
+        return local_avi
+    except OSError as e:
+        print(f"Error copying {video_path}: {e}")
+        if local_avi is not None and os.path.exists(local_avi):
+            os.remove(local_avi)
+        return None
+
+def upload_video(local_mp4, output_mp4):
+    """This function copies a new video from the local scratch folder to the output folder 
+    and removes the local file
+
+    Args:
+        local_mp4 (str): path to the local video in mp4
+        output_mp4 (str): path to the new video in mp4
+    """    
+
+    try:
+        # Copied with PART_SUFFIX first and renamed when the copy is complete
+        shutil.copyfile(local_mp4, f"{output_mp4}{PART_SUFFIX}")
+        os.replace(f"{output_mp4}{PART_SUFFIX}", output_mp4)
+    except OSError as e:
+        print(f"Error copying {output_mp4}: {e}")
+        if os.path.exists(f"{output_mp4}{PART_SUFFIX}"):
+            os.remove(f"{output_mp4}{PART_SUFFIX}")
+    finally:
+        os.remove(local_mp4)
+
+async def conversion_worker(queue, codec, threads, pbar, cores=None, scratch_dir=None, backend='ffmpeg',
+                            preset='veryfast'):
+    """This function takes batches from the queue and transforms them one after the other, 
+    until the queue is empty. With a scratch folder the videos are copied and transformed one by one
 
     Args:
-        params (str): path of the video to transform
+        queue (asyncio.Queue): batches with the paths of the videos
+        codec (str): name of the ffmpeg encoder
+        threads (int): number of threads of every ffmpeg process
+        pbar (tqdm): progress bar of the videos
+        cores (list, optional): cores of this worker, if None any core. Defaults to None.
+        scratch_dir (str, optional): local folder for the copies of the videos, see process_videos. Defaults to None.
+        backend (str, optional): 'ffmpeg' or 'pyav', see process_videos. Defaults to 'ffmpeg'.
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
     """    
 
-    # Get the path, relative path and name of the video
-    video_path, base_output_dir, input_dir = params
+    if scratch_dir is None:
+        while not queue.empty():
+            batch = queue.get_nowait()
+            for video_path, _ in await process_video_batch(batch, codec, threads, cores, backend, preset):
+                print(f"Error converting {video_path}")
+            pbar.update(len(batch))
+        return
 
-    # Generate the output directory for the MP4 files
-    relative_path = os.path.relpath(video_path, input_dir)
-    sub_dirs = relative_path.split(os.sep)
-    output_dir = os.path.join(base_output_dir, *sub_dirs[:-1])
-    
-    # Create the new path
-    os.makedirs(output_dir, exist_ok=True)
+    # Videos of the batches of this worker, they are copied one by one
+    videos = []
+    def next_video():
+        if not videos and not queue.empty():
+            videos.extend(queue.get_nowait())
+        return videos.pop(0) if videos else None
 
-    # Convert AVI to MP4 and save it in the output directory
-    mp4_video_path = convert_avi_to_mp4(video_path, output_dir)
+    # The next video is downloaded and the previous one uploaded while ffmpeg converts the current one,
+    # at most one video is copied in each direction
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as worker_dir:
+        video = next_video()
+        download = asyncio.create_task(asyncio.to_thread(download_video, video[0], worker_dir)) if video else None
+        upload = None
+        while video is not None:
+            video_path, output_mp4 = video
+            local_avi = await download
 
-def process_videos(input_dir, output_dir):
+            video = next_video()
+            download = asyncio.create_task(asyncio.to_thread(download_video, video[0], worker_dir)) if video else None
+
+            # A video that could not be copied was already reported
+            if local_avi is not None:
+                local_mp4 = f"{os.path.splitext(local_avi)[0]}.mp4"
+                if await process_video_batch([(local_avi, local_mp4)], codec, threads, cores, backend, preset):
+                    print(f"Error converting {video_path}")
+                os.remove(local_avi)
+
+                if upload is not None:
+                    await upload
+                    upload = None
+                if os.path.exists(local_mp4):
+                    upload = asyncio.create_task(asyncio.to_thread(upload_video, local_mp4, output_mp4))
+            pbar.update(1)
+        if upload is not None:
+            await upload
+
+async def run_conversions(batches, codec, jobs, threads, total, scratch_dir=None, backend='ffmpeg',
+                          preset='veryfast'):
+    """This function transforms all the videos, running at most jobs ffmpeg at the same time
+
+    Args:
+        batches (list): batches with the paths of the videos
+        codec (str): name of the ffmpeg encoder
+        jobs (int): number of ffmpeg processes running at the same time
+        threads (int): number of threads of every ffmpeg process
+        total (int): number of videos
+        scratch_dir (str, optional): local folder for the copies of the videos, see process_videos. Defaults to None.
+        backend (str, optional): 'ffmpeg' or 'pyav', see process_videos. Defaults to 'ffmpeg'.
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
+    """    
+
+    # A fixed number of workers take the batches as they finish the previous one, 
+    # the progress is updated in the order the batches finish
+    queue = asyncio.Queue()
+    for batch in batches:
+        queue.put_nowait(batch)
+    # Every worker has its own cores (only in Linux, other systems don't support it)
+    if TASKSET_PATH and hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+        worker_cores = [available[i * threads:(i + 1) * threads] or None for i in range(jobs)]
+    else:
+        worker_cores = [None] * jobs
+
+    with tqdm(total=total, desc="Processing videos") as pbar:
+        await asyncio.gather(*(conversion_worker(queue, codec, threads, pbar, cores, scratch_dir, backend, preset)
+                               for cores in worker_cores))
+
+def process_videos(input_dir, output_dir, codec=None, jobs=None, ffmpeg_threads=4, scratch_dir=None,
+                   backend='ffmpeg', preset='veryfast'):
     """This function loops into all the videos to transform
 
     Args:
         input_dir (str): path which contains all the videos in avi
         output_dir (str): path to the new videos in mp4
+        codec (str, optional): encoder of the videos, see build_ffmpeg_batch_command. Defaults to None.
+        jobs (int, optional): number of ffmpeg processes running at the same time, if None the cores 
+                              are divided by ffmpeg_threads. Defaults to None.
+        ffmpeg_threads (int, optional): number of threads of every ffmpeg process. Defaults to 4.
+        scratch_dir (str, optional): local folder (e.g. tempfile.gettempdir()) where every worker copies the
+                                     videos one at a time before converting them, so a remote volume is read
+                                     and written while ffmpeg runs. If None they are read and written in place.
+                                     Defaults to None.
+        backend (str, optional): 'ffmpeg' to run one ffmpeg command for every batch or 'pyav' to convert 
+                                 the videos inside python with libx264 (needs the av package), without 
+                                 starting a process for every batch. Defaults to 'ffmpeg'.
+        preset (str, optional): preset of the encoder, see build_ffmpeg_batch_command. Defaults to 'veryfast'.
     """    
 
-    # List with the video files
-    video_files = []
+    # PyAV always encodes with libx264 in the CPU
+    if backend == 'pyav' and av is None:
+        print("PyAV is not installed, using ffmpeg.")
+        backend = 'ffmpeg'
+    if backend == 'pyav':
+        codec = 'libx264'
+
+    # Choose the encoder only once for all the videos
+    if codec is None:
+        codec = default_codec()
+    print(f"Using the {codec} encoder ({backend}).")
 
     # Looping into the folders to get the videos to tranform
     print("Scanning for video files...")
-    for root, dirs, files in tqdm(os.walk(input_dir), desc="Walking through directories"):
-        for filename in files:
-            if filename.endswith(".avi"):
-                video_path = os.path.join(root, filename)
-                video_files.append((video_path, output_dir, input_dir))
-    print(f"Found {len(video_files)} video files to process.")
+    video_paths = scan_files(input_dir, ".avi")
+    print(f"Found {len(video_paths)} video files.")
+
+    # Scanning once the videos that were already converted, instead of checking every file
+    done = set()
+    if os.path.isdir(output_dir):
+        done = {os.path.splitext(os.path.relpath(path, output_dir))[0] for path in scan_files(output_dir, ".mp4")}
+
+    # Grouping the videos of the same folder, so one ffmpeg converts several of them
+    folders = {}
+    for video_path in video_paths:
+        folders.setdefault(os.path.dirname(video_path), []).append(video_path)
+
+    # One ffmpeg converts at most one video per thread, so its decoders and encoders keep to ffmpeg_threads
+    batch_size = max(1, min(BATCH_SIZE, ffmpeg_threads))
+
+    # The output folder is computed once per folder, not for every video.
+    # Skip conversion if the MP4 file already exists
+    batches = []
+    output_dirs = set()
+    total = 0
+    for root, paths in folders.items():
+        relative_root = os.path.relpath(root, input_dir)
+        out_root = os.path.join(output_dir, relative_root)
+
+        videos = []
+        for video_path in paths:
+            video_name = os.path.splitext(os.path.basename(video_path))[0]
+            if os.path.normpath(os.path.join(relative_root, video_name)) not in done:
+                videos.append((video_path, os.path.join(out_root, f"{video_name}.mp4")))
+        batches.extend(videos[i:i + batch_size] for i in range(0, len(videos), batch_size))
+        if videos:
+            output_dirs.add(out_root)
+        total += len(videos)
+    print(f"{total} video files to process, {len(video_paths) - total} already converted.")
+
+    # Create the new paths before the conversion, only once for each folder
+    for out_root in output_dirs:
+        os.makedirs(out_root, exist_ok=True)
+    if scratch_dir is not None:
+        os.makedirs(scratch_dir, exist_ok=True)
 
-    # Using the cores of the computer
-    num_cores = cpu_count() - 1
-    print(f"Using {num_cores} cores for parallel processing.")
+    # A few ffmpeg at the same time, all their threads together use the cores of the computer.
+    # Only the cores this process can run on are counted (a container can have less than the computer)
+    if jobs is None:
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else cpu_count()
+        jobs = max(1, num_cores // ffmpeg_threads)
+    print(f"Running {jobs} ffmpeg processes with {ffmpeg_threads} threads each.")
 
     # Tranforming the videos
-    print("Starting conversion and frame extraction...")
-    with Pool(num_cores) as pool:
-        list(tqdm(pool.imap(process_video_file, video_files), total=len(video_files), desc="Processing videos"))
-    print("Conversion and frame extraction completed.")
+    print("Starting conversion...")
+    asyncio.run(run_conversions(batches, codec, jobs, ffmpeg_threads, total, scratch_dir, backend, preset))
+    print("Conversion completed.")
 
 if __name__ == "__main__":
     input_directory = "//Volumes/CFElab/Data_archive/Images/ISIIS/RAW/"